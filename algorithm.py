@@ -8,48 +8,61 @@ So the result is basically a directed graph with this constraint.
 I need you to design, implement, test and visualize this algorithm for me.
 """
 import random
-import json
 
-from collections import defaultdict
+import orjson
+
+from itertools import chain
 
 class Matcher:
+    """Match every element to an element of another set.
+
+    This is a perfect matching in the bipartite graph of givers and
+    receivers where edges only join elements of different sets. One exists
+    exactly when no set holds more than half of all elements, which is
+    checked up front instead of searching for a matching that cannot exist.
+    """
+
     def __init__(self, sets: list[set]):
         self.sets = sets
-        self.matches = defaultdict(str)
-        
+        self.matches: dict[str, str] = {}
+        self._elem_to_set = {e: i for i, s in enumerate(sets) for e in s}
+        self._all_elements = set().union(*sets)
+        self._groups = [list(s) for s in sets]
+        self._largest = max(map(len, self._groups), default=0)
+
     def generate_matches(self) -> dict[str, str]:
-        """Generate matches between elements of different sets."""
-        # Create a list of all elements and their set indices
-        elements = [(elem, idx) for idx, s in enumerate(self.sets) 
-                   for elem in s]
-        
-        # Shuffle elements to get random matches
-        unmatched = elements.copy()
-        
-        while unmatched:
-            current_elem, current_set_idx = unmatched.pop(0)
-            
-            # Find possible matches (elements from other sets)
-            possible_matches = [
-                (elem, set_idx) for elem, set_idx in unmatched
-                if set_idx != current_set_idx and elem not in self.matches.values()
-            ]
-            
-            # If no possible matches, try elements that are already matched
-            if not possible_matches:
-                possible_matches = [
-                    (elem, set_idx) for elem, set_idx in elements
-                    if set_idx != current_set_idx and 
-                    elem != current_elem and
-                    elem not in self.matches.values()
-                ]
-            
-            if possible_matches:
-                # Select a random match
-                match_elem, _ = random.choice(possible_matches)
-                self.matches[current_elem] = match_elem
-            
-        return dict(self.matches)
+        """Generate matches between elements of different sets.
+
+        All elements are shuffled within their set and laid out set by set,
+        largest set first. The first half of that list fills the even
+        positions of ``order`` and the second half the odd ones, so that
+        neighbours always come from different sets as long as no set holds
+        more than half of all elements. Every element is then matched to its
+        successor in ``order`` (wrapping around), which forms a single cycle:
+        for more than two elements no two people ever draw each other.
+        """
+        n = sum(map(len, self._groups))
+        if n < 2 or 2 * self._largest > n:
+            raise ValueError(
+                "No valid matching exists: the largest set must contain "
+                "at most half of all elements"
+            )
+
+        # Create a list of all elements, grouped by set, in random order
+        for group in self._groups:
+            random.shuffle(group)
+        groups = random.sample(self._groups, len(self._groups))
+        groups.sort(key=len, reverse=True)
+        elements = list(chain.from_iterable(groups))
+
+        # Interleave both halves and match everyone to their successor
+        half = (n + 1) // 2
+        order = [None] * n
+        order[0::2] = elements[:half]
+        order[1::2] = elements[half:]
+        self.matches = dict(zip(order, order[1:] + order[:1]))
+
+        return self.matches
 
     def verify_matches(self) -> bool:
         """Verify that the matching follows all constraints."""
@@ -57,16 +70,25 @@ class Matcher:
             return False
             
         # Check if each element has exactly one match
-        elements = set().union(*self.sets)
+        elements = self._all_elements
         if len(self.matches) != len(elements):
             return False
+
+        # Check if each element is matched to exactly once
+        matched_receivers = set(self.matches.values())
+        if len(matched_receivers) != len(elements):
+            return False
             
         # Check if matches are between different sets
         for elem, match in self.matches.items():
-            elem_set = next(i for i, s in enumerate(self.sets) if elem in s)
-            match_set = next(i for i, s in enumerate(self.sets) if match in s)
-            if elem_set == match_set:
+            if self._elem_to_set[elem] == self._elem_to_set[match]:
                 return False
+
+        # Check that nobody draws the person who drew them
+        if len(elements) > 2 and any(
+            self.matches[match] == elem for elem, match in self.matches.items()
+        ):
+            return False
                 
         return True
 
@@ -74,20 +96,16 @@ class Matcher:
 def test_matcher(sets):
 
     matcher = Matcher(sets)
-    
-    matches = None
-    while True:
-        matches = matcher.generate_matches()
-        is_valid = matcher.verify_matches()
-        if is_valid:
-            break
+    matches = matcher.generate_matches()
+    if not matcher.verify_matches():
+        raise RuntimeError("Generated matches violate the matching constraints")
 
     return matches
 
 if __name__ == "__main__":
     email_mapping_path = "email_mapping.json"
-    with open(email_mapping_path, "r") as f:
-        sets = json.load(f)
+    with open(email_mapping_path, "rb") as f:
+        sets = orjson.loads(f.read())
     matches = test_matcher(sets)
-    with open("matches.json", "w") as f:
-        json.dump(matches, f, indent=4, ensure_ascii=False)
\ No newline at end of file
+    with open("matches.json", "wb") as f:
+        f.write(orjson.dumps(matches, option=orjson.OPT_INDENT_2))
\ No newline at end of file
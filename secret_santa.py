@@ -1,17 +1,36 @@
-import json
+import base64
+import functools
 import logging
+import os
+import queue
+import random
+import re
 import smtplib
+import socket
+import string
+import textwrap
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from jinja2 import Template
+from jinja2 import (
+    BaseLoader,
+    Environment,
+    FileSystemBytecodeCache,
+    TemplateNotFound,
+)
+import orjson
 
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.header import Header
 
 
 @dataclass
 class EmailConfig:
-    """Email server configuration."""
+    """Email server configuration.
+
+    ``username`` doubles as the From address of every email and, like the
+    participants' addresses, must be ASCII.
+    """
     smtp_server: str
     port: int
     username: str
@@ -53,79 +72,312 @@ class EmailTemplate:
     der Wichtel-Bot kann leider keine Antworten lesen 🤖
     """
     def __init__(self, template_path: str = None):
+        self.template = None
+        self.default_template = _to_string_template(self.DEFAULT_TEMPLATE)
         if template_path:
             try:
-                with open(template_path, 'r') as f:
-                    self.template = Template(f.read())
-            except FileNotFoundError:
-                logging.warning(f"Template file {template_path} not found, using default template")
-                self.template = Template(self.DEFAULT_TEMPLATE)
-        else:
-            self.template = Template(self.DEFAULT_TEMPLATE)
+                self.template = _ENV.get_template(os.path.abspath(template_path))
+            except TemplateNotFound:
+                logging.warning("Template file %s not found, using default template", template_path)
 
     def render(self, sender_name: str, recipient_name: str) -> str:
         """Render the email template with given names."""
+        if self.template is None:
+            return self.default_template.substitute(
+                sender_name=sender_name,
+                recipient_name=recipient_name
+            )
         return self.template.render(
             sender_name=sender_name,
             recipient_name=recipient_name
         )
 
+class _PathLoader(BaseLoader):
+    """Load templates by absolute file path."""
+
+    def get_source(self, environment, template):
+        try:
+            with open(template, encoding="utf-8") as f:
+                source = f.read()
+            mtime = os.path.getmtime(template)
+        except FileNotFoundError:
+            raise TemplateNotFound(template)
+
+        def uptodate() -> bool:
+            try:
+                return os.path.getmtime(template) == mtime
+            except OSError:
+                return False
+
+        return source, template, uptodate
+
+# Shared environment so compiled custom templates are cached in memory and
+# as bytecode on disk across runs
+_ENV = Environment(
+    loader=_PathLoader(),
+    bytecode_cache=FileSystemBytecodeCache(),
+)
+@functools.lru_cache(maxsize=None)
+def _to_string_template(source: str) -> string.Template:
+    """Convert a Jinja template that only substitutes ``{{ name }}`` placeholders.
+
+    The default template needs nothing else, and string.Template renders it
+    without going through Jinja's render pipeline. The result matches what
+    Jinja renders for the dedented source.
+    """
+    source = textwrap.dedent(source).replace("$", "$$")
+    # Jinja drops a single trailing newline by default
+    if source.endswith("\n"):
+        source = source[:-1]
+    return string.Template(re.sub(r"\{\{\s*(\w+)\s*\}\}", r"${\1}", source))
+
+# Compile the built-in template at import time, EmailTemplate instances then
+# get it from the cache
+_DEFAULT_STRING_TEMPLATE = _to_string_template(EmailTemplate.DEFAULT_TEMPLATE)
+
+class PipeliningSMTP(smtplib.SMTP):
+    """SMTP client that pipelines the mail envelope (RFC 2920).
+
+    When the server advertises PIPELINING, MAIL FROM, all RCPT TO commands
+    and DATA are written in one go and their replies are read afterwards,
+    saving a round trip per command. Otherwise plain smtplib is used.
+    The message must already be bytes with CRLF line endings.
+    """
+
+    def sendmail(self, from_addr, to_addrs, msg: bytes, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("pipelining"):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+
+        esmtp_opts = []
+        if self.has_extn("size"):
+            esmtp_opts.append("size=%d" % len(msg))
+        esmtp_opts.extend(mail_options)
+        if any(x.lower() == "smtputf8" for x in esmtp_opts):
+            if not self.has_extn("smtputf8"):
+                raise smtplib.SMTPNotSupportedError(
+                    "SMTPUTF8 not supported by server")
+            self.command_encoding = "utf-8"
+
+        mail_opts = "".join(" " + option for option in esmtp_opts)
+        rcpt_opts = "".join(" " + option for option in rcpt_options)
+        commands = ["mail FROM:%s%s" % (smtplib.quoteaddr(from_addr), mail_opts)]
+        commands += ["rcpt TO:%s%s" % (smtplib.quoteaddr(addr), rcpt_opts) for addr in to_addrs]
+        commands.append("data")
+        self.send("".join(command + smtplib.CRLF for command in commands))
+
+        # A 421 means the server is closing the connection, so no further
+        # replies will arrive
+        mail_code, mail_resp = self.getreply()
+        if mail_code == 421:
+            self.close()
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        senderrs = {}
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+            if code == 421:
+                self.close()
+                raise smtplib.SMTPRecipientsRefused(senderrs)
+        data_code, data_resp = self.getreply()
+
+        if data_code == 354:
+            if mail_code != 250 or len(senderrs) == len(to_addrs):
+                # The server accepted DATA anyway, end it with an empty body
+                self.send(b"." + smtplib.bCRLF)
+                self.getreply()
+            else:
+                data = re.sub(rb"(?m)^\.", b"..", msg)
+                if data[-2:] != smtplib.bCRLF:
+                    data += smtplib.bCRLF
+                self.send(data + b"." + smtplib.bCRLF)
+                data_code, data_resp = self.getreply()
+
+        if data_code == 421:
+            self.close()
+        elif mail_code != 250 or len(senderrs) == len(to_addrs) or data_code != 250:
+            try:
+                self.rset()
+            except smtplib.SMTPServerDisconnected:
+                pass
+
+        if mail_code != 250:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if len(senderrs) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        if data_code != 250:
+            raise smtplib.SMTPDataError(data_code, data_resp)
+        return senderrs
+
 class SecretSantaEmailer:
     """Handles the secret santa email sending process."""
+
+    # Temporary failures worth retrying (service unavailable, mailbox busy, ...)
+    TRANSIENT_SMTP_CODES = (421, 450, 451, 452, 454, 554)
+    # Seconds before a blocking socket operation gives up
+    SMTP_TIMEOUT = 30
     
     def __init__(self, email_config: EmailConfig, template: EmailTemplate = None):
         self.config = email_config
         self.template = template or EmailTemplate()
         self.logger = logging.getLogger(__name__)
+        # Every header but To is the same for all participants. Addresses are
+        # written as is, so a non-ASCII username fails here already.
+        self._header_suffix = (
+            f"From: {self.config.username}\r\n"
+            f"Subject: {Header('Deine Wichtel-Aufgabe! 🎄', 'utf-8').encode()}\r\n"
+            "MIME-Version: 1.0\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            "Content-Transfer-Encoding: base64\r\n"
+            "\r\n"
+        ).encode("ascii")
 
-    def _create_email_message(self, to_email: str, sender_name: str, recipient_name: str) -> MIMEMultipart:
-        """Create email message with secret santa assignment."""
-        message = MIMEMultipart()
-        message["From"] = self.config.username
-        message["To"] = to_email
-        message["Subject"] = "Deine Wichtel-Aufgabe! 🎄"
-
+    def _create_email_message(self, to_email: str, sender_name: str, recipient_name: str) -> bytes:
+        """Create the raw email message with secret santa assignment."""
         body = self.template.render(sender_name=sender_name, recipient_name=recipient_name)
-        message.attach(MIMEText(body, "plain"))
-        
-        return message
+        encoded_body = base64.encodebytes(body.encode("utf-8")).replace(b"\n", b"\r\n")
+
+        return f"To: {to_email}\r\n".encode("ascii") + self._header_suffix + encoded_body
+
+    def _connect(self) -> smtplib.SMTP:
+        """Open a logged-in connection to the email server."""
+        server = PipeliningSMTP(self.config.smtp_server, self.config.port, timeout=self.SMTP_TIMEOUT)
+        try:
+            # Detect dead connections instead of hanging on them
+            server.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+                server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 15)
+                server.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 4)
+            server.starttls()
+            server.login(self.config.username, self.config.password)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    def _send_with_retry(
+            self,
+            server: smtplib.SMTP,
+            to_email: str,
+            message: bytes,
+            max_attempts: int = 4
+        ) -> smtplib.SMTP:
+        """Send a message, retrying transient server errors with exponential backoff.
+
+        Returns the connection to keep using, which is a new one if the server
+        closed the previous one with a 421. If sending fails for good, any
+        connection opened here is closed again before the error is raised.
+        """
+        connection = server
+        for attempt in range(max_attempts):
+            try:
+                connection.sendmail(self.config.username, [to_email], message)
+                return connection
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # Refused recipients carry one reply per address instead of a single code
+                if isinstance(e, smtplib.SMTPRecipientsRefused):
+                    codes = {code for code, _ in e.recipients.values()}
+                else:
+                    codes = {e.smtp_code}
+                transient = codes <= set(self.TRANSIENT_SMTP_CODES)
+                if not transient or attempt == max_attempts - 1:
+                    if connection is not server:
+                        connection.close()
+                    raise
+                self.logger.warning("Transient SMTP error %s, retrying: %s", sorted(codes), e)
+                time.sleep(2 ** attempt + random.random())
+                if 421 in codes:
+                    # The server closes the connection after a 421
+                    connection.close()
+                    connection = self._connect()
+
+    def _prepare_messages(
+            self,
+            matches: dict[str, str],
+            email_dict: dict[str, str]
+        ) -> list[tuple[str, str, bytes]]:
+        """Render and build the assignment email for every participant."""
+        messages = []
+        for sender_name, recipient_name in matches.items():
+            sender_email = email_dict.get(sender_name)
+            if not sender_email:
+                self.logger.error("No email found for %s", sender_name)
+                continue
+
+            try:
+                message = self._create_email_message(
+                    sender_email,
+                    sender_name,
+                    recipient_name
+                )
+            except Exception as e:
+                self.logger.error("Failed to create email for %s: %s", sender_name, e)
+                continue
+            messages.append((sender_name, sender_email, message))
+
+        return messages
+
+    def _send_worker(self, jobs: queue.Queue) -> None:
+        """Send queued assignments over a dedicated connection until the sentinel."""
+        # smtplib connections are not thread-safe, so each worker owns one
+        server = self._connect()
+        try:
+            while (job := jobs.get()) is not None:
+                sender_name, sender_email, message = job
+                try:
+                    if server.sock is None:
+                        server = self._connect()
+                    server = self._send_with_retry(server, sender_email, message)
+                    self.logger.info("Successfully sent assignment email to %s", sender_name)
+                    
+                except Exception as e:
+                    self.logger.error("Failed to send email to %s: %s", sender_name, e)
+        finally:
+            try:
+                server.quit()
+            except smtplib.SMTPException:
+                server.close()
 
     def send_mails(
             self, 
             matches: dict[str, str], 
-            email_mapping: list[dict[str, str]]
+            email_mapping: dict[str, str],
+            concurrency: int = 5
         ) -> None:
-        """Send secret santa assignment emails to all participants."""
-        # Convert email mapping list to dictionary for easier lookup
-        email_dict = {k: v for d in email_mapping for k, v in d.items()}
+        """Send secret santa assignment emails to all participants.
+
+        Emails are sent by up to ``concurrency`` workers, each with its own
+        connection. Keep this low, providers throttle parallel sessions.
+        """
+        # Build everything up front so the workers only do network I/O
+        messages = self._prepare_messages(matches, email_mapping)
         
-        try:
-            with smtplib.SMTP(self.config.smtp_server, self.config.port) as server:
-                server.starttls()
-                server.login(self.config.username, self.config.password)
-                
-                for sender_name, recipient_name in matches.items():
-                    try:
-                        sender_email = email_dict.get(sender_name)
-                        if not sender_email:
-                            self.logger.error(f"No email found for {sender_name}")
-                            continue
-
-                        message = self._create_email_message(
-                            sender_email,
-                            sender_name,
-                            recipient_name
-                        )
-                        
-                        server.send_message(message)
-                        self.logger.info(f"Successfully sent assignment email to {sender_name}")
-                        
-                    except Exception as e:
-                        self.logger.error(f"Failed to send email to {sender_name}: {str(e)}")
-                        
-        except Exception as e:
-            self.logger.error(f"Failed to connect to email server: {str(e)}")
-            raise
+        workers = max(1, min(concurrency, len(messages)))
+        jobs = queue.Queue()
+        for job in messages:
+            jobs.put(job)
+        for _ in range(workers):
+            jobs.put(None)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._send_worker, jobs)
+                for _ in range(workers)
+            ]
+
+        # A worker only fails if it cannot connect. Any worker that did connect
+        # drains the queue before reaching a sentinel, so the run only failed
+        # if no worker got through.
+        errors = [e for future in futures if (e := future.exception())]
+        for e in errors:
+            self.logger.error("Failed to connect to email server: %s", e)
+        if len(errors) == workers:
+            raise errors[0]
 
 # Example usage:
 if __name__ == "__main__":
@@ -144,23 +396,23 @@ if __name__ == "__main__":
     #     "Name3": "Name1"
     # }
     
-    # email_mapping = [
-    #     {"Name1": "marcelbraasch@gmail.com"},
-    #     {"Name2": "marcelbraasch@gmail.com"},
-    #     {"Name3": "marcelbraasch@gmail.com"},
-    # ]
+    # email_mapping = {
+    #     "Name1": "marcelbraasch@gmail.com",
+    #     "Name2": "marcelbraasch@gmail.com",
+    #     "Name3": "marcelbraasch@gmail.com",
+    # }
 
     # Sample data
     matches_path = "matches.json"
-    with open(matches_path, "r") as f:
-        matches = json.load(f)
+    with open(matches_path, "rb") as f:
+        matches = orjson.loads(f.read())
 
     # Email mapping
     email_mapping_path = "email_mapping.json"
-    with open(email_mapping_path, "r") as f:
-        unformatted = json.load(f)
+    with open(email_mapping_path, "rb") as f:
+        unformatted = orjson.loads(f.read())
         # flatten the list of dictionaries
-        email_mapping = [{k: v} for d in unformatted for k, v in d.items()]
+        email_mapping = {k: v for d in unformatted for k, v in d.items()}
 
 
     # Initialize and send emails
@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+from algorithm import Matcher
+
+
+def random_sets(rng: random.Random) -> list[set]:
+    """Build random sets where a valid matching always exists."""
+    while True:
+        sets = [
+            {f"{i}-{j}" for j in range(rng.randint(1, 5))}
+            for i in range(rng.randint(2, 6))
+        ]
+        sizes = [len(s) for s in sets]
+        if 2 * max(sizes) <= sum(sizes):
+            return sets
+
+
+def test_generate_matches_is_valid():
+    rng = random.Random(0)
+    for _ in range(500):
+        sets = random_sets(rng)
+        matcher = Matcher(sets)
+        matches = matcher.generate_matches()
+
+        set_of = {e: i for i, s in enumerate(sets) for e in s}
+        assert sorted(matches) == sorted(set_of)
+        assert sorted(matches.values()) == sorted(set_of)
+        assert all(set_of[a] != set_of[b] for a, b in matches.items())
+        assert matcher.verify_matches()
+
+
+@pytest.mark.parametrize("sets", [
+    [{"A", "B"}, {"C", "D"}],
+    [{"A", "B"}, {"C", "D"}, {"E", "F"}],
+    [{"A", "B", "C"}, {"D", "E", "F"}],
+])
+def test_generate_matches_has_no_mutual_pairs(sets):
+    for _ in range(200):
+        matches = Matcher(sets).generate_matches()
+        assert all(matches[b] != a for a, b in matches.items())
+
+
+def test_generate_matches_rejects_impossible_sets():
+    with pytest.raises(ValueError):
+        Matcher([{"A", "B", "C"}, {"D"}]).generate_matches()
+
+
+def test_verify_matches_rejects_mutual_pairs():
+    matcher = Matcher([{"A"}, {"B"}, {"C"}, {"D"}, {"E"}])
+    matcher.matches = {"A": "B", "B": "A", "C": "D", "D": "E", "E": "C"}
+    assert not matcher.verify_matches()
+
+    matcher.matches = {"A": "B", "B": "C", "C": "D", "D": "E", "E": "A"}
+    assert matcher.verify_matches()
+
+
+def test_verify_matches_allows_a_single_pair():
+    matcher = Matcher([{"A"}, {"B"}])
+    matcher.generate_matches()
+    assert matcher.matches == {"A": "B", "B": "A"}
+    assert matcher.verify_matches()
@@ -0,0 +1,374 @@
+import email
+import email.policy
+import smtplib
+import socketserver
+import textwrap
+import threading
+
+import jinja2
+import pytest
+
+import secret_santa
+from secret_santa import EmailConfig, EmailTemplate, PipeliningSMTP, SecretSantaEmailer
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """Minimal local SMTP server with scriptable replies.
+
+    ``failures`` maps a command verb (``MAIL``, ``RCPT``, ``DATA``, or
+    ``BODY`` for the reply after the message) to a list of replies that are
+    used once each before falling back to success. A ``421`` reply closes
+    the connection like a real server would.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, pipelining: bool = True):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.pipelining = pipelining
+        self.failures = {}
+        self.commands = []
+        self.received = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def reply_for(self, verb: str, default: bytes) -> bytes:
+        with self.lock:
+            queued = self.failures.get(verb)
+            return queued.pop(0) if queued else default
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line: bytes) -> bool:
+        """Send a reply and return whether the connection stays open."""
+        self.wfile.write(line + b"\r\n")
+        return not line.startswith(b"421")
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply(b"220 fake ESMTP")
+        mail_from, rcpts = None, []
+        while line := self.rfile.readline():
+            command = line.rstrip(b"\r\n")
+            verb = command.split(b" ", 1)[0].split(b":", 1)[0].upper().decode()
+            with server.lock:
+                server.commands.append(command)
+
+            if verb == "EHLO":
+                extensions = [b"250-fake", b"250-SIZE 1000000"]
+                if server.pipelining:
+                    extensions.append(b"250-PIPELINING")
+                extensions.append(b"250 8BITMIME")
+                self.wfile.write(b"\r\n".join(extensions) + b"\r\n")
+            elif verb == "MAIL":
+                reply = server.reply_for(verb, b"250 sender ok")
+                if reply.startswith(b"250"):
+                    mail_from, rcpts = command, []
+                if not self.reply(reply):
+                    return
+            elif verb == "RCPT":
+                reply = server.reply_for(verb, b"250 recipient ok")
+                if reply.startswith(b"250"):
+                    rcpts.append(command)
+                if not self.reply(reply):
+                    return
+            elif verb == "DATA":
+                valid = mail_from is not None and bool(rcpts)
+                reply = server.reply_for(verb, b"354 go ahead" if valid else b"554 no valid recipients")
+                if not self.reply(reply):
+                    return
+                if reply.startswith(b"354"):
+                    body = b""
+                    while (line := self.rfile.readline()) != b".\r\n":
+                        body += line
+                    reply = server.reply_for("BODY", b"250 queued" if valid else b"554 no valid recipients")
+                    if reply.startswith(b"250"):
+                        with server.lock:
+                            server.received.append((mail_from, rcpts, body))
+                    if not self.reply(reply):
+                        return
+                mail_from, rcpts = None, []
+            elif verb == "RSET":
+                mail_from, rcpts = None, []
+                self.reply(b"250 reset")
+            elif verb == "QUIT":
+                self.reply(b"221 bye")
+                return
+            else:
+                self.reply(b"502 not implemented")
+
+
+@pytest.fixture
+def smtp_server():
+    server = FakeSMTPServer()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(smtp_server):
+    client = PipeliningSMTP("127.0.0.1", smtp_server.port)
+    client.sent = []
+    send = client.send
+
+    def record(data):
+        client.sent.append(data)
+        send(data)
+
+    client.send = record
+    yield client
+    client.close()
+
+
+MESSAGE = b"Subject: hi\r\n\r\n.leading dot\r\nbody\r\n"
+
+
+def test_sendmail_pipelines_envelope(client, smtp_server):
+    assert client.sendmail("santa@example.com", ["anna@example.com"], MESSAGE) == {}
+
+    envelope = next(data for data in client.sent if "mail FROM" in str(data))
+    assert "rcpt TO:<anna@example.com>" in envelope
+    assert envelope.endswith("data\r\n")
+    [(_, rcpts, body)] = smtp_server.received
+    assert rcpts == [b"rcpt TO:<anna@example.com>"]
+    assert body == b"Subject: hi\r\n\r\n..leading dot\r\nbody\r\n"
+
+
+def test_sendmail_without_pipelining_falls_back(client, smtp_server):
+    smtp_server.pipelining = False
+    assert client.sendmail("santa@example.com", ["anna@example.com"], MESSAGE) == {}
+    assert not any("mail FROM" in str(data) and "data" in str(data) for data in client.sent)
+    assert len(smtp_server.received) == 1
+
+
+def test_sendmail_returns_partially_refused_recipients(client, smtp_server):
+    smtp_server.failures["RCPT"] = [b"550 no such user"]
+    refused = client.sendmail("santa@example.com", ["anna@example.com", "ben@example.com"], MESSAGE)
+    assert refused == {"anna@example.com": (550, b"no such user")}
+    [(_, rcpts, _)] = smtp_server.received
+    assert rcpts == [b"rcpt TO:<ben@example.com>"]
+
+
+@pytest.mark.parametrize("verb, error", [
+    ("MAIL", smtplib.SMTPSenderRefused),
+    ("RCPT", smtplib.SMTPRecipientsRefused),
+    ("DATA", smtplib.SMTPDataError),
+    ("BODY", smtplib.SMTPDataError),
+])
+def test_sendmail_refusal_resets_and_keeps_connection(client, smtp_server, verb, error):
+    smtp_server.failures[verb] = [b"550 refused" if verb != "DATA" else b"503 bad sequence"]
+    with pytest.raises(error):
+        client.sendmail("santa@example.com", ["anna@example.com"], MESSAGE)
+    assert smtp_server.received == []
+    assert smtp_server.commands[-1].upper() == b"RSET"
+
+    assert client.sendmail("santa@example.com", ["anna@example.com"], MESSAGE) == {}
+    assert len(smtp_server.received) == 1
+
+
+def test_sendmail_ends_data_accepted_after_refusal(client, smtp_server):
+    smtp_server.failures["RCPT"] = [b"550 no such user"]
+    smtp_server.failures["DATA"] = [b"354 go ahead"]
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        client.sendmail("santa@example.com", ["anna@example.com"], MESSAGE)
+    assert client.sent[-2] == b".\r\n"
+    assert smtp_server.received == []
+
+    assert client.sendmail("santa@example.com", ["anna@example.com"], MESSAGE) == {}
+    assert len(smtp_server.received) == 1
+
+
+@pytest.mark.parametrize("verb, error", [
+    ("MAIL", smtplib.SMTPSenderRefused),
+    ("RCPT", smtplib.SMTPRecipientsRefused),
+    ("DATA", smtplib.SMTPDataError),
+    ("BODY", smtplib.SMTPDataError),
+])
+def test_sendmail_closes_connection_on_421(client, smtp_server, verb, error):
+    smtp_server.failures[verb] = [b"421 closing"]
+    with pytest.raises(error) as excinfo:
+        client.sendmail("santa@example.com", ["anna@example.com"], MESSAGE)
+    codes = excinfo.value.recipients.values() if verb == "RCPT" else [(excinfo.value.smtp_code, None)]
+    assert [code for code, _ in codes] == [421]
+    assert client.sock is None
+    assert smtp_server.received == []
+
+
+@pytest.fixture
+def emailer(smtp_server, monkeypatch):
+    monkeypatch.setattr(secret_santa.time, "sleep", lambda seconds: None)
+    emailer = SecretSantaEmailer(EmailConfig("127.0.0.1", smtp_server.port, "santa@example.com", ""))
+    # The fake server speaks neither STARTTLS nor AUTH
+    monkeypatch.setattr(emailer, "_connect", lambda: PipeliningSMTP("127.0.0.1", smtp_server.port))
+    return emailer
+
+
+@pytest.mark.parametrize("verb, reply", [
+    ("MAIL", b"451 try again"),
+    ("RCPT", b"450 mailbox busy"),
+    ("BODY", b"452 out of storage"),
+])
+def test_send_mails_retries_transient_errors(emailer, smtp_server, verb, reply):
+    smtp_server.failures[verb] = [reply]
+    emailer.send_mails({"Anna": "Ben"}, {"Anna": "anna@example.com"})
+    assert len(smtp_server.received) == 1
+
+
+@pytest.mark.parametrize("verb", ["MAIL", "RCPT", "DATA"])
+def test_send_mails_reconnects_after_421(emailer, smtp_server, verb):
+    smtp_server.failures[verb] = [b"421 closing"]
+    emailer.send_mails({"Anna": "Ben"}, {"Anna": "anna@example.com"})
+    assert len(smtp_server.received) == 1
+    assert smtp_server.connections == 2
+
+
+def test_send_mails_does_not_retry_permanent_errors(emailer, smtp_server):
+    smtp_server.failures["RCPT"] = [b"550 no such user"]
+    emailer.send_mails({"Anna": "Ben"}, {"Anna": "anna@example.com"})
+    assert smtp_server.received == []
+    assert sum(command.upper().startswith(b"RCPT") for command in smtp_server.commands) == 1
+
+
+def test_send_mails_gives_up_after_max_attempts(emailer, smtp_server):
+    smtp_server.failures["RCPT"] = [b"450 mailbox busy"] * 4
+    emailer.send_mails(
+        {"Anna": "Ben", "Ben": "Anna"},
+        {"Anna": "anna@example.com", "Ben": "ben@example.com"},
+        concurrency=1
+    )
+    assert len(smtp_server.received) == 1
+    assert sum(command.upper().startswith(b"RCPT") for command in smtp_server.commands) == 5
+
+
+@pytest.mark.parametrize("path", ["absolute", "relative_to_parent", "absolute_with_parent"])
+def test_email_template_loads_any_path(tmp_path, monkeypatch, path):
+    template_file = tmp_path / "mail.j2"
+    template_file.write_text("{{ sender_name }} -> {{ recipient_name }}", encoding="utf-8")
+    workdir = tmp_path / "work"
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+
+    template_path = {
+        "absolute": str(template_file),
+        "relative_to_parent": "../mail.j2",
+        "absolute_with_parent": str(workdir / ".." / "mail.j2"),
+    }[path]
+    assert EmailTemplate(template_path).render("Anna", "Ben") == "Anna -> Ben"
+
+
+def test_email_template_falls_back_to_default(tmp_path):
+    template = EmailTemplate(str(tmp_path / "missing.j2"))
+    assert template.render("Anna", "Ben") == EmailTemplate().render("Anna", "Ben")
+
+
+def test_default_template_matches_jinja():
+    rendered = EmailTemplate().render("Anna", "Ben")
+    assert "Anna" in rendered and "Ben" in rendered
+    assert not any(token in rendered for token in ("{{", "}}", "$"))
+
+    source = textwrap.dedent(EmailTemplate.DEFAULT_TEMPLATE)
+    assert rendered == jinja2.Template(source).render(sender_name="Anna", recipient_name="Ben")
+
+
+def test_default_template_can_be_overridden():
+    class DollarTemplate(EmailTemplate):
+        DEFAULT_TEMPLATE = """
+            {{sender_name}} schenkt {{ recipient_name }} etwas für 20-30 $
+        """
+
+    assert DollarTemplate().render("Anna", "Ben") == "\nAnna schenkt Ben etwas für 20-30 $"
+
+
+def test_send_mails_skips_participants_whose_email_cannot_be_built(emailer, smtp_server):
+    emailer.send_mails(
+        {"Anna": "Ben", "Ben": "Anna"},
+        {"Anna": "anna@exämple.com", "Ben": "ben@example.com"}
+    )
+    assert len(smtp_server.received) == 1
+
+
+def flaky_connect(smtp_server, failures: int):
+    """Return a _connect replacement whose first calls fail."""
+    calls = []
+    lock = threading.Lock()
+
+    def connect():
+        with lock:
+            calls.append(None)
+            if len(calls) <= failures:
+                raise OSError("boom")
+        return PipeliningSMTP("127.0.0.1", smtp_server.port)
+
+    return connect
+
+
+def participants(n: int) -> tuple[dict[str, str], dict[str, str]]:
+    names = [f"P{i}" for i in range(n)]
+    matches = {name: names[(i + 1) % n] for i, name in enumerate(names)}
+    return matches, {name: f"{name.lower()}@example.com" for name in names}
+
+
+def test_send_mails_spreads_messages_over_all_workers(emailer, smtp_server):
+    emailer.send_mails(*participants(20), concurrency=3)
+    assert sorted(rcpts for _, rcpts, _ in smtp_server.received) == sorted(
+        [f"rcpt TO:<p{i}@example.com>".encode()] for i in range(20)
+    )
+    assert smtp_server.connections == 3
+
+
+def test_send_mails_survives_a_worker_that_cannot_connect(emailer, smtp_server, monkeypatch):
+    monkeypatch.setattr(emailer, "_connect", flaky_connect(smtp_server, failures=1))
+    emailer.send_mails(*participants(20), concurrency=3)
+    assert len(smtp_server.received) == 20
+    assert smtp_server.connections == 2
+
+
+def test_send_mails_raises_if_no_worker_can_connect(emailer, smtp_server, monkeypatch):
+    monkeypatch.setattr(emailer, "_connect", flaky_connect(smtp_server, failures=3))
+    with pytest.raises(OSError, match="boom"):
+        emailer.send_mails(*participants(20), concurrency=3)
+    assert smtp_server.received == []
+
+
+def test_connect_closes_connection_when_setup_fails(smtp_server, monkeypatch):
+    opened = []
+
+    class RecordingSMTP(PipeliningSMTP):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            opened.append(self)
+
+    monkeypatch.setattr(secret_santa, "PipeliningSMTP", RecordingSMTP)
+    emailer = SecretSantaEmailer(EmailConfig("127.0.0.1", smtp_server.port, "santa@example.com", ""))
+    # The fake server does not offer STARTTLS
+    with pytest.raises(smtplib.SMTPNotSupportedError):
+        emailer._connect()
+    [server] = opened
+    assert server.sock is None
+
+
+def test_create_email_message_is_a_valid_email():
+    emailer = SecretSantaEmailer(EmailConfig("localhost", 25, "santa@example.com", ""))
+    raw = emailer._create_email_message("anna@example.com", "Anna", "Jürgen")
+
+    message = email.message_from_bytes(raw, policy=email.policy.default)
+    assert message["To"] == "anna@example.com"
+    assert message["From"] == "santa@example.com"
+    assert message["Subject"] == "Deine Wichtel-Aufgabe! 🎄"
+    assert message.get_content_type() == "text/plain"
+    assert message.get_content() == emailer.template.render("Anna", "Jürgen")
+
+
+def test_emailer_rejects_non_ascii_username():
+    with pytest.raises(UnicodeEncodeError):
+        SecretSantaEmailer(EmailConfig("localhost", 25, "weihnachtsmänner@example.com", ""))